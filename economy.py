@@ -1,13 +1,31 @@
-import json
 import random
+import time
 import asyncio
-from datetime import datetime
+from datetime import date
 from pathlib import Path
+
+import orjson
 from astrbot.core import AstrBotConfig
 from astrbot import logger
 
+from .utils import DebouncedFlusher, atomic_write
+
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def _today() -> int:
+    """本地时区的当前日期，以 1970-01-01 起的天数表示"""
+    now = int(time.time())
+    return (now + time.localtime(now).tm_gmtoff) // 86400
+
 
 class EconomyManager:
+    # 数据落盘的防抖间隔(秒)，窗口内的多次变更合并为一次日志追加
+    FLUSH_DELAY = 0.5
+    # 操作日志累计条数达到该值后重写快照并清空日志
+    COMPACT_EVERY = 1000
+
     def __init__(self, data_dir: Path, config: AstrBotConfig):
         self.data_dir = data_dir
         self.conf = config
@@ -16,106 +34,195 @@ class EconomyManager:
         self.user_counts_file = self.data_dir / "user_counts.json"
         self.group_counts_file = self.data_dir / "group_counts.json"
         self.user_checkin_file = self.data_dir / "user_checkin.json"
+        self.ops_log_file = self.data_dir / "ops.log"
 
         # 内存缓存
         self.user_counts = {}
         self.group_counts = {}
         self.user_checkin_data = {}
 
+        # 延迟写盘状态: 变更先追加到 ops.log，定期压缩为快照
+        self._pending_ops: list[bytes] = []
+        self._ops_since_compact = 0
+        self._flusher = DebouncedFlusher(self._flush_pending, self.FLUSH_DELAY)
+        self._ops_fp = None
+
+        # 扣费开关: 配置保存后 AstrBot 会重新实例化插件，这里缓存一次即可
+        self._enable_user_limit = bool(self.conf.get("enable_user_limit", True))
+        self._enable_group_limit = bool(self.conf.get("enable_group_limit", False))
+
         self._load_all()
+        self._ops_fp = self.ops_log_file.open("ab")
 
     def _load_all(self):
-        """加载所有数据"""
+        """加载快照并重放操作日志"""
         self.user_counts = self._load_json(self.user_counts_file)
         self.group_counts = self._load_json(self.group_counts_file)
         self.user_checkin_data = self._load_json(self.user_checkin_file)
+        replayed = self._replay_ops()
+        migrated = self._migrate_checkin()
+        purged = self._purge_stale()
+        if replayed or migrated or purged:
+            self._write_snapshots(self._snapshots())
+
+    def _purge_stale(self) -> int:
+        """清理过期签到记录和零次数条目 (缺省值即为 0)，返回清理条数"""
+        before = len(self.user_checkin_data) + len(self.user_counts) + len(self.group_counts)
+        yesterday = _today() - 1
+        self.user_checkin_data = {k: v for k, v in self.user_checkin_data.items() if v >= yesterday}
+        self.user_counts = {k: v for k, v in self.user_counts.items() if v != 0}
+        self.group_counts = {k: v for k, v in self.group_counts.items() if v != 0}
+        return before - len(self.user_checkin_data) - len(self.user_counts) - len(self.group_counts)
+
+    def _migrate_checkin(self) -> int:
+        """将旧版 "YYYY-MM-DD" 签到日期转换为整数天数，返回转换条数"""
+        count = 0
+        for uid, day in self.user_checkin_data.items():
+            if isinstance(day, str):
+                try:
+                    self.user_checkin_data[uid] = date.fromisoformat(day).toordinal() - _EPOCH_ORDINAL
+                except ValueError:
+                    self.user_checkin_data[uid] = 0
+                count += 1
+        return count
 
     def _load_json(self, path: Path) -> dict:
         if not path.exists(): return {}
         try:
-            return json.loads(path.read_text(encoding="utf-8"))
-        except:
+            return orjson.loads(path.read_bytes())
+        except (OSError, orjson.JSONDecodeError):
             return {}
 
-    async def _save_json(self, path: Path, data: dict):
+    def _table(self, kind: str) -> dict:
+        if kind == "user": return self.user_counts
+        if kind == "group": return self.group_counts
+        return self.user_checkin_data
+
+    def _snapshots(self) -> list[tuple[Path, dict]]:
+        return [
+            (self.user_counts_file, dict(self.user_counts)),
+            (self.group_counts_file, dict(self.group_counts)),
+            (self.user_checkin_file, dict(self.user_checkin_data)),
+        ]
+
+    def _replay_ops(self) -> int:
+        """按顺序重放日志中记录的最新值，返回重放条数"""
+        if not self.ops_log_file.exists(): return 0
+        count = 0
+        for line in self.ops_log_file.read_bytes().splitlines():
+            try:
+                op = orjson.loads(line)
+                self._table(op["k"])[op["id"]] = op["v"]
+                count += 1
+            except (orjson.JSONDecodeError, KeyError, TypeError):
+                # 进程中断时可能残留不完整的行
+                continue
+        return count
+
+    def _write_snapshots(self, snapshots: list[tuple[Path, dict]]):
+        """原子写入全部快照并清空操作日志"""
         try:
-            await asyncio.to_thread(path.write_text, json.dumps(data, indent=2), encoding="utf-8")
+            for path, data in snapshots:
+                atomic_write(path, orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+            if self._ops_fp is None:
+                self.ops_log_file.write_bytes(b"")
+            else:
+                self._ops_fp.truncate(0)
         except Exception as e:
-            logger.error(f"保存数据失败 {path}: {e}")
+            logger.error(f"保存数据快照失败: {e}")
+
+    def _append_ops(self, data: bytes):
+        self._ops_fp.write(data)
+        self._ops_fp.flush()
+
+    def _record(self, kind: str, key: str):
+        """记录一条变更，由后台任务合并追加到操作日志"""
+        op = {"k": kind, "id": key, "v": self._table(kind)[key]}
+        self._pending_ops.append(orjson.dumps(op) + b"\n")
+        self._flusher.mark()
+
+    async def _flush_pending(self):
+        if self._pending_ops:
+            ops, self._pending_ops = self._pending_ops, []
+            try:
+                await asyncio.to_thread(self._append_ops, b"".join(ops))
+            except Exception as e:
+                logger.error(f"写入操作日志失败 {self.ops_log_file}: {e}")
+            self._ops_since_compact += len(ops)
+        if self._ops_since_compact >= self.COMPACT_EVERY:
+            await self._compact()
+
+    async def _compact(self):
+        self._ops_since_compact = 0
+        await asyncio.to_thread(self._write_snapshots, self._snapshots())
+
+    async def close(self):
+        """等待后台写盘任务结束，落盘剩余变更并压缩日志"""
+        await self._flusher.close()
+        await self._compact()
+        self._ops_fp.close()
+        self._ops_fp = None
 
     # --- 对外接口 ---
 
+    @property
+    def user_limit_enabled(self) -> bool:
+        return self._enable_user_limit
+
     def get_user_count(self, user_id: str) -> int:
         return self.user_counts.get(str(user_id), 0)
 
     def get_group_count(self, group_id: str) -> int:
         return self.group_counts.get(str(group_id), 0)
 
-    async def check_and_deduct(self, user_id: str, group_id: str = None) -> tuple[bool, str]:
-        """检查并扣除次数。返回: (是否成功, 提示信息)"""
+    async def check_and_deduct(self, user_id: str, group_id: str = None) -> tuple[bool, str, str | None]:
+        """检查并扣除次数。返回: (是否成功, 提示信息, 扣费来源 "user"/"group"，未扣费为 None)"""
+        # 1. 检查开关 (使用初始化时缓存的值)
+        # 如果都没开限制，直接通过
+        if not self._enable_user_limit and not self._enable_group_limit:
+            return True, "无限制模式", None
+
         uid = str(user_id)
         gid = str(group_id) if group_id else None
-
-        # 1. 检查开关
-        enable_user_limit = self.conf.get("enable_user_limit", True)
-        enable_group_limit = self.conf.get("enable_group_limit", False)
-
-        # 如果都没开限制，直接通过
-        if not enable_user_limit and not enable_group_limit:
-            return True, "无限制模式"
+        use_group = gid is not None and self._enable_group_limit
 
         cost = 1  # 默认消耗1次，如果支持强力模式这里可变
 
         # 2. 扣费逻辑
-        # 优先扣用户，如果开启了群限制且支持回退，逻辑会比较复杂。
-        # 这里简化为：优先看用户限制，再看群限制。
-
-        deducted = False
-        source = ""
+        # 优先扣用户，个人次数不足时回退到群次数。
 
         # 检查群
-        if gid and enable_group_limit:
-            g_cnt = self.group_counts.get(gid, 0)
-            if g_cnt < cost:
-                # 群次数不够，且开启了群限制 -> 失败 (除非后续逻辑允许混合)
-                return False, f"本群剩余次数不足 ({g_cnt}次)"
+        g_cnt = self.group_counts.get(gid, 0) if use_group else 0
+        if use_group and g_cnt < cost:
+            # 群次数不够，且开启了群限制 -> 失败
+            return False, f"本群剩余次数不足 ({g_cnt}次)", None
 
         # 检查个人
-        if enable_user_limit:
+        if self._enable_user_limit:
             u_cnt = self.user_counts.get(uid, 0)
             if u_cnt >= cost:
                 self.user_counts[uid] = u_cnt - cost
-                deducted = True
-                source = "user"
-            else:
-                # 个人不够，看看能不能扣群的 (如果有这个逻辑需求)
-                if gid and enable_group_limit:
-                    g_cnt = self.group_counts.get(gid, 0)
-                    if g_cnt >= cost:
-                        self.group_counts[gid] = g_cnt - cost
-                        deducted = True
-                        source = "group"
-                    else:
-                        return False, f"您的次数不足 ({u_cnt})，且群次数也不足 ({g_cnt})"
-                else:
-                    return False, f"您的次数不足 ({u_cnt})"
-        elif gid and enable_group_limit:
-            # 没开个人限制，只开群限制
-            g_cnt = self.group_counts.get(gid, 0)
-            if g_cnt >= cost:
-                self.group_counts[gid] = g_cnt - cost
-                deducted = True
-                source = "group"
-            else:
-                return False, f"本群次数不足"
+                self._record("user", uid)
+                return True, "success", "user"
+            if not use_group:
+                return False, f"您的次数不足 ({u_cnt})", None
+        elif not use_group:
+            return True, "未开启限制", None  # 兜底
 
-        # 保存变更
-        if deducted:
-            if source == "user": await self._save_json(self.user_counts_file, self.user_counts)
-            if source == "group": await self._save_json(self.group_counts_file, self.group_counts)
-            return True, "success"
+        # 个人不够或只开了群限制 -> 扣群 (上面已确认群次数充足)
+        self.group_counts[gid] = g_cnt - cost
+        self._record("group", gid)
+        return True, "success", "group"
 
-        return True, "未开启限制"  # 兜底
+    async def refund(self, source: str | None, user_id: str, group_id: str = None) -> bool:
+        """生成失败时退还 1 次到扣费来源 (check_and_deduct 返回的 "user"/"group")。返回是否退还"""
+        if source == "user":
+            await self.admin_add_points(user_id, 1, is_group=False)
+            return True
+        if source == "group" and group_id:
+            await self.admin_add_points(group_id, 1, is_group=True)
+            return True
+        return False
 
     async def checkin(self, user_id: str) -> str:
         """用户签到"""
@@ -123,7 +230,7 @@ class EconomyManager:
             return "❌ 签到功能未开启。"
 
         uid = str(user_id)
-        today = datetime.now().strftime("%Y-%m-%d")
+        today = _today()
 
         if self.user_checkin_data.get(uid) == today:
             curr = self.user_counts.get(uid, 0)
@@ -140,8 +247,8 @@ class EconomyManager:
         self.user_counts[uid] = current + reward
         self.user_checkin_data[uid] = today
 
-        await self._save_json(self.user_counts_file, self.user_counts)
-        await self._save_json(self.user_checkin_file, self.user_checkin_data)
+        self._record("user", uid)
+        self._record("checkin", uid)
 
         return f"🎉 签到成功！获得 {reward} 次。\n当前剩余: {self.user_counts[uid]}"
 
@@ -151,10 +258,10 @@ class EconomyManager:
         if is_group:
             curr = self.group_counts.get(tid, 0)
             self.group_counts[tid] = curr + count
-            await self._save_json(self.group_counts_file, self.group_counts)
+            self._record("group", tid)
             return f"✅ 已为群 {tid} 增加 {count} 次 (当前: {self.group_counts[tid]})"
         else:
             curr = self.user_counts.get(tid, 0)
             self.user_counts[tid] = curr + count
-            await self._save_json(self.user_counts_file, self.user_counts)
+            self._record("user", tid)
             return f"✅ 已为用户 {tid} 增加 {count} 次 (当前: {self.user_counts[tid]})"
\ No newline at end of file
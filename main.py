@@ -1,10 +1,12 @@
+import asyncio
 import base64
-import json
 import re
 from datetime import datetime
+from pathlib import Path
 from typing import List
 
 import aiohttp
+import orjson
 from astrbot import logger
 from astrbot.api.event import filter
 from astrbot.api.star import Context, Star, register, StarTools
@@ -13,16 +15,39 @@ from astrbot.core.message.components import At, Image, Plain, Node, Nodes
 from astrbot.core.platform.astr_message_event import AstrMessageEvent
 
 from .preset_manager import PresetManager
-from .utils import ImageWorkflow, TableGenerator
+from .utils import DebouncedFlusher, ImageWorkflow, TableGenerator, atomic_write
 from .economy import EconomyManager
 
+try:
+    import pybase64
+except ImportError:  # 可选依赖，未安装时回退到标准库
+    pybase64 = None
+
+
+def _b64encode(data: bytes) -> str:
+    if pybase64 is not None:
+        return pybase64.b64encode_as_string(data)
+    return base64.b64encode(data).decode('ascii')
+
+
+# 从 API 文本响应中提取图片链接
+_MD_IMG_RE = re.compile(r'!\[.*?\]\((.*?)\)')
+_URL_RE = re.compile(r'https?://[^\s)]+')
+
 
 class FigurineProPlugin(Star):
+    # 预览图映射写盘的防抖间隔(秒)
+    IMAGE_MAP_FLUSH_DELAY = 0.5
+
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
         self.conf = config
         self.data_dir = StarTools.get_data_dir()
 
+        # 配置保存后 AstrBot 会重新实例化插件，这里缓存一次即可
+        self._admins = frozenset(str(a) for a in (self.conf.get("admins_id") or []))
+        self._blacklist = frozenset(str(u) for u in (self.conf.get("user_blacklist") or []))
+
         self.preset_manager = PresetManager(self.data_dir)
         self.economy = EconomyManager(self.data_dir, self.conf)
         self.iwf = ImageWorkflow(
@@ -34,33 +59,47 @@ class FigurineProPlugin(Star):
         self.preset_images_dir.mkdir(parents=True, exist_ok=True)
         self.preset_images_map_file = self.data_dir / "preset_images_map.json"
         self.preset_images_map = {}
+        self._image_map_dirty = False
+        self._image_map_flusher = DebouncedFlusher(self._flush_image_map, self.IMAGE_MAP_FLUSH_DELAY)
         self._load_image_map()
 
     def _load_image_map(self):
         try:
             if self.preset_images_map_file.exists():
-                self.preset_images_map = json.loads(self.preset_images_map_file.read_text(encoding='utf-8'))
+                self.preset_images_map = orjson.loads(self.preset_images_map_file.read_bytes())
         except:
             self.preset_images_map = {}
 
-    def _save_image_map(self):
+    def _mark_image_map_dirty(self):
+        """标记映射已变更，由后台任务合并写盘"""
+        self._image_map_dirty = True
+        self._image_map_flusher.mark()
+
+    async def _flush_image_map(self):
+        if not self._image_map_dirty: return
+        self._image_map_dirty = False
+        data = orjson.dumps(self.preset_images_map, option=orjson.OPT_INDENT_2)
         try:
-            self.preset_images_map_file.write_text(json.dumps(self.preset_images_map, indent=2), encoding='utf-8')
-        except:
-            pass
+            await asyncio.to_thread(atomic_write, self.preset_images_map_file, data)
+        except Exception as e:
+            logger.error(f"保存预览图映射失败: {e}")
+
+    async def terminate(self):
+        await self._image_map_flusher.close()
+        await self.economy.close()
+        await self.iwf.terminate()
 
     def is_admin(self, event: AstrMessageEvent) -> bool:
         """检查发送者是否为配置文件中的管理员"""
-        sender = event.get_sender_id()
-        admins = self.conf.get("admins_id", [])
-        return str(sender) in admins
+        return str(event.get_sender_id()) in self._admins
 
-    async def _call_api(self, image_bytes_list: List[bytes], prompt: str) -> bytes | str:
+    async def _call_api(self, image_bytes_list: List[bytes], prompt: str, api_mode: str | None = None) -> bytes | str:
         """调用 LLM API 生成图片"""
-        api_mode = self.conf.get("api_mode", "generic")
+        api_mode = api_mode or self.conf.get("api_mode", "generic")
         model = self.conf.get("model", "nano-banana")
 
         payload = {}
+        body = None
         headers = {"Content-Type": "application/json"}
         url = ""
 
@@ -80,11 +119,27 @@ class FigurineProPlugin(Star):
                 parts.append({
                     "inlineData": {
                         "mimeType": "image/png",
-                        "data": base64.b64encode(img).decode('utf-8')
+                        "data": _b64encode(img)
                     }
                 })
             payload = {"contents": [{"parts": parts}]}
 
+        elif api_mode == "multipart":
+            # Multipart 格式构造: 图片以原始字节上传，无需 Base64
+            base_url = self.conf.get("multipart_api_url") or self.conf.get("generic_api_url", "https://api.bltcy.ai/v1/chat/completions")
+            keys = self.conf.get("generic_api_keys", [])
+            if not keys: return "❌ 未配置 Generic API Key"
+
+            url = base_url
+            # Content-Type (含 boundary) 由 aiohttp 自动生成
+            headers = {"Authorization": f"Bearer {keys[0]}"}
+
+            body = aiohttp.FormData()
+            body.add_field("model", model)
+            body.add_field("prompt", prompt)
+            for i, img in enumerate(image_bytes_list):
+                body.add_field(f"image{i}", img, filename=f"i{i}.png", content_type="image/png")
+
         else:
             # Generic / OpenAI 格式构造
             base_url = self.conf.get("generic_api_url", "https://api.bltcy.ai/v1/chat/completions")
@@ -101,7 +156,7 @@ class FigurineProPlugin(Star):
 
             user_content = [{"type": "text", "text": prompt}]
             for img in image_bytes_list:
-                b64 = base64.b64encode(img).decode('utf-8')
+                b64 = _b64encode(img)
                 user_content.append({
                     "type": "image_url",
                     "image_url": {"url": f"data:image/png;base64,{b64}"}
@@ -118,105 +173,117 @@ class FigurineProPlugin(Star):
         # ---------------- 2. 发送请求与解析响应 ----------------
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=payload, headers=headers, proxy=self.iwf.proxy) as resp:
-                    if resp.status != 200:
-                        text = await resp.text()
+            session = self.iwf.get_session()
+            if body is None: body = orjson.dumps(payload)
+            fallback = False
+            async with session.post(url, data=body, headers=headers, proxy=self.iwf.proxy) as resp:
+                if resp.status != 200:
+                    text = await resp.text()
+                    if api_mode == "multipart" and resp.status in (404, 405, 415):
+                        fallback = True
+                    else:
                         return f"API Error {resp.status}: {text[:200]}"
-
+                else:
                     data = await resp.json()
-                    img_url = None
-
-                    # --- 解析逻辑开始 ---
-
-                    # 1. 检查 Choices 列表 (Banana/Chat 格式)
-                    if "choices" in data and len(data["choices"]) > 0:
-                        message = data["choices"][0].get("message", {})
-
-                        # [A] 优先检查 images 字段
-                        # 结构: message -> images list -> item -> image_url dict -> url
-                        if "images" in message and isinstance(message["images"], list) and len(message["images"]) > 0:
-                            first_img = message["images"][0]
-                            # 情况 A1: 嵌套在 image_url 里
-                            if isinstance(first_img, dict) and "image_url" in first_img:
-                                if isinstance(first_img["image_url"], dict):
-                                    img_url = first_img["image_url"].get("url")
-                                elif isinstance(first_img["image_url"], str):
-                                    img_url = first_img["image_url"]
-                            # 情况 A2: 直接在对象里
-                            elif isinstance(first_img, dict) and "url" in first_img:
-                                img_url = first_img["url"]
-                            # 情况 A3: 纯字符串 URL
-                            elif isinstance(first_img, str):
-                                img_url = first_img
-
-                        # [B] 如果 images 里没找到，再看 content (Markdown/Text)
-                        if not img_url:
-                            content = message.get("content")
-                            if content:  # 只有 content 不为空才正则
-                                # 匹配 Markdown 图片
-                                match = re.search(r'\!\[.*?\]\((.*?)\)', content)
-                                if match:
-                                    img_url = match.group(1)
-                                else:
-                                    # 匹配纯 URL
-                                    match = re.search(r'https?://[^\s)]+', content)
-                                    if match: img_url = match.group(0)
-
-                        # [C] 检查非标准的 image_url 字段
-                        if not img_url and "image_url" in message:
-                            if isinstance(message["image_url"], dict):
-                                img_url = message["image_url"].get("url")
-                            elif isinstance(message["image_url"], str):
-                                img_url = message["image_url"]
-
-                    # 2. 检查 DALL-E 标准格式 (data 列表)
-                    elif "data" in data and isinstance(data["data"], list) and len(data["data"]) > 0:
-                        item = data["data"][0]
-                        if "url" in item:
-                            img_url = item["url"]
-                        elif "b64_json" in item:
-                            img_url = f"data:image/png;base64,{item['b64_json']}"
-
-                    # 3. 检查 Gemini 格式
-                    elif "candidates" in data and len(data["candidates"]) > 0:
-                        try:
-                            parts = data["candidates"][0]["content"]["parts"]
-                            for p in parts:
-                                if "inlineData" in p:
-                                    img_url = f"data:{p['inlineData']['mimeType']};base64,{p['inlineData']['data']}"
-                                    break
-                                if "text" in p and p["text"]:
-                                    match = re.search(r'https?://[^\s)]+', p["text"])
-                                    if match:
-                                        img_url = match.group(0)
-                                        break
-                        except:
-                            pass
-
-                    # --- 解析逻辑结束 ---
-
-                    if not img_url:
-                        # 构造详细的错误信息
-                        error_detail = str(data)[:200]
-                        if "choices" in data and data["choices"][0]["message"].get("content") is None:
-                            return f"API返回空内容(Content is None)，且未找到图片数据。原始响应片段: {error_detail}"
-                        return f"无法提取图片链接。原始响应片段: {error_detail}"
-
-                    # ---------------- 3. 处理图片数据 (下载或解码) ----------------
-
-                    # 情况 A: Base64 数据
-                    if img_url.startswith("data:"):
-                        try:
-                            # 格式如 data:image/jpeg;base64,/9j/4AAQSk...
-                            # 分割出逗号后面的部分
-                            base64_data = img_url.split(",", 1)[1]
-                            return base64.b64decode(base64_data)
-                        except Exception as e:
-                            return f"Base64解码失败: {e}"
-
-                    # 情况 B: HTTP 链接 -> 需要下载
-                    return await self.iwf.download_image(img_url) or "❌ 图片下载失败 (连接超时)"
+
+            # 先退出响应上下文释放连接，再进行回退重试或后续解析/下载
+            if fallback:
+                # 网关不支持 multipart，回退到 JSON + Base64
+                logger.warning(f"[手办化] 网关不支持 multipart ({resp.status})，回退到 Generic 模式")
+                return await self._call_api(image_bytes_list, prompt, api_mode="generic")
+
+            img_url = None
+
+            # --- 解析逻辑开始 ---
+
+            # 1. 检查 Choices 列表 (Banana/Chat 格式)
+            if "choices" in data and len(data["choices"]) > 0:
+                message = data["choices"][0].get("message", {})
+
+                # [A] 优先检查 images 字段
+                # 结构: message -> images list -> item -> image_url dict -> url
+                if "images" in message and isinstance(message["images"], list) and len(message["images"]) > 0:
+                    first_img = message["images"][0]
+                    # 情况 A1: 嵌套在 image_url 里
+                    if isinstance(first_img, dict) and "image_url" in first_img:
+                        if isinstance(first_img["image_url"], dict):
+                            img_url = first_img["image_url"].get("url")
+                        elif isinstance(first_img["image_url"], str):
+                            img_url = first_img["image_url"]
+                    # 情况 A2: 直接在对象里
+                    elif isinstance(first_img, dict) and "url" in first_img:
+                        img_url = first_img["url"]
+                    # 情况 A3: 纯字符串 URL
+                    elif isinstance(first_img, str):
+                        img_url = first_img
+
+                # [B] 如果 images 里没找到，再看 content (Markdown/Text)
+                if not img_url:
+                    content = message.get("content")
+                    if content:  # 只有 content 不为空才正则
+                        # 匹配 Markdown 图片
+                        match = _MD_IMG_RE.search(content)
+                        if match:
+                            img_url = match.group(1)
+                        else:
+                            # 匹配纯 URL
+                            match = _URL_RE.search(content)
+                            if match: img_url = match.group(0)
+
+                # [C] 检查非标准的 image_url 字段
+                if not img_url and "image_url" in message:
+                    if isinstance(message["image_url"], dict):
+                        img_url = message["image_url"].get("url")
+                    elif isinstance(message["image_url"], str):
+                        img_url = message["image_url"]
+
+            # 2. 检查 DALL-E 标准格式 (data 列表)
+            elif "data" in data and isinstance(data["data"], list) and len(data["data"]) > 0:
+                item = data["data"][0]
+                if "url" in item:
+                    img_url = item["url"]
+                elif "b64_json" in item:
+                    img_url = f"data:image/png;base64,{item['b64_json']}"
+
+            # 3. 检查 Gemini 格式
+            elif "candidates" in data and len(data["candidates"]) > 0:
+                try:
+                    parts = data["candidates"][0]["content"]["parts"]
+                    for p in parts:
+                        if "inlineData" in p:
+                            img_url = f"data:{p['inlineData']['mimeType']};base64,{p['inlineData']['data']}"
+                            break
+                        if "text" in p and p["text"]:
+                            match = _URL_RE.search(p["text"])
+                            if match:
+                                img_url = match.group(0)
+                                break
+                except:
+                    pass
+
+            # --- 解析逻辑结束 ---
+
+            if not img_url:
+                # 构造详细的错误信息
+                error_detail = str(data)[:200]
+                if "choices" in data and data["choices"][0]["message"].get("content") is None:
+                    return f"API返回空内容(Content is None)，且未找到图片数据。原始响应片段: {error_detail}"
+                return f"无法提取图片链接。原始响应片段: {error_detail}"
+
+            # ---------------- 3. 处理图片数据 (下载或解码) ----------------
+
+            # 情况 A: Base64 数据
+            if img_url.startswith("data:"):
+                try:
+                    # 格式如 data:image/jpeg;base64,/9j/4AAQSk...
+                    # 分割出逗号后面的部分
+                    base64_data = img_url.split(",", 1)[1]
+                    return base64.b64decode(base64_data)
+                except Exception as e:
+                    return f"Base64解码失败: {e}"
+
+            # 情况 B: HTTP 链接 -> 需要下载
+            return await self.iwf.download_image(img_url) or "❌ 图片下载失败 (连接超时)"
 
         except Exception as e:
             logger.error(f"API Call Failed: {e}")
@@ -225,25 +292,30 @@ class FigurineProPlugin(Star):
     @filter.event_message_type(filter.EventMessageType.ALL, priority=5)
     async def on_message(self, event: AstrMessageEvent):
         """处理所有消息，匹配预设指令"""
+        # 快速过滤: 首字符不可能命中任何预设的普通聊天直接跳过
+        if not self.preset_manager.may_match(event.message_str): return
+
         text = event.message_str.strip()
-        if not text: return
 
-        parts = text.split()
+        parts = text.split(maxsplit=1)
         cmd = parts[0]
 
         # 检查是否命中预设
+        if not self.preset_manager.has_prompt(cmd): return
         prompt_template = self.preset_manager.get_prompt(cmd)
         if not prompt_template: return
 
         sender_id = event.get_sender_id()
 
-        if str(sender_id) in (self.conf.get("user_blacklist") or []):
+        if str(sender_id) in self._blacklist:
             return
 
         skip_cost = self.is_admin(event)
 
+        # 本次扣费来源 ("user"/"group")，失败时按来源退还
+        charged = None
         if not skip_cost:
-            success, msg = await self.economy.check_and_deduct(sender_id, event.get_group_id())
+            success, msg, charged = await self.economy.check_and_deduct(sender_id, event.get_group_id())
             if not success:
                 tip = msg
                 if self.conf.get("enable_checkin", False):
@@ -253,7 +325,7 @@ class FigurineProPlugin(Star):
 
         yield event.plain_result(f"🎨 收到 [{cmd}] 请求，正在绘图...")
 
-        additional_text = " ".join(parts[1:])
+        additional_text = parts[1] if len(parts) > 1 else ""
         full_prompt = f"{prompt_template}, {additional_text}" if additional_text else prompt_template
 
         images = await self.iwf.get_images_from_event(event)
@@ -261,11 +333,7 @@ class FigurineProPlugin(Star):
         # 如果不是纯文生图模式(text_only)，且没图，报错
         if not images and "text_only" not in prompt_template:
             # 失败返还次数 (因为没开始生成)
-            if not skip_cost:
-                if self.conf.get("enable_user_limit"):
-                    await self.economy.admin_add_points(sender_id, 1, is_group=False)
-                elif self.conf.get("enable_group_limit") and event.get_group_id():
-                    await self.economy.admin_add_points(event.get_group_id(), 1, is_group=True)
+            await self.economy.refund(charged, sender_id, event.get_group_id())
             yield event.plain_result("⚠️ 请发送一张图片，或引用图片后输入命令。")
             return
 
@@ -274,15 +342,22 @@ class FigurineProPlugin(Star):
         if isinstance(result, bytes):
             filename = f"{cmd}_{int(datetime.now().timestamp())}.png"
             file_path = self.preset_images_dir / filename
-            file_path.write_bytes(result)
-
-            # 更新映射
-            self.preset_images_map[cmd] = str(file_path)
-            self._save_image_map()
+            try:
+                await asyncio.to_thread(atomic_write, file_path, result)
+
+                # 更新映射 (缩略图在生成列表时按需创建)，并清理旧预览图的缩略图
+                old_path = self.preset_images_map.get(cmd)
+                self.preset_images_map[cmd] = str(file_path)
+                self._mark_image_map_dirty()
+                if old_path and old_path != str(file_path):
+                    await asyncio.to_thread(TableGenerator.remove_thumbnails, Path(old_path))
+            except Exception as e:
+                # 预览图保存失败不影响本次结果的发送
+                logger.error(f"[手办化] 保存预览图失败 {file_path}: {e}")
 
             # 构建回复
             info_text = f"✅ {cmd} 完成"
-            if not skip_cost and self.conf.get("enable_user_limit"):
+            if not skip_cost and self.economy.user_limit_enabled:
                 remain = self.economy.get_user_count(sender_id)
                 info_text += f" | 剩余次数: {remain}"
 
@@ -291,16 +366,11 @@ class FigurineProPlugin(Star):
                 Plain(info_text)
             ])
         else:
-            if not skip_cost:
-                # 判断刚才扣的是用户还是群组
-                if self.conf.get("enable_user_limit"):
-                    # 退还用户
-                    await self.economy.admin_add_points(sender_id, 1, is_group=False)
+            # 退还到刚才实际扣费的用户或群组
+            if await self.economy.refund(charged, sender_id, event.get_group_id()):
+                if charged == "user":
                     logger.info(f"[手办化] 生成失败，已自动退还用户 {sender_id} 1次额度")
-
-                elif self.conf.get("enable_group_limit") and event.get_group_id():
-                    # 退还群组
-                    await self.economy.admin_add_points(event.get_group_id(), 1, is_group=True)
+                else:
                     logger.info(f"[手办化] 生成失败，已自动退还群组 {event.get_group_id()} 1次额度")
 
             yield event.plain_result(f"❌ 生成失败: {result}\n(检测到生成失败，已自动返还扣除的次数)")
@@ -366,24 +436,25 @@ class FigurineProPlugin(Star):
     async def cmd_add_points(self, event: AstrMessageEvent):
         if not self.is_admin(event): return
 
-        parts = event.message_str.split()
         target = None
         count = None
 
-        nums = [x for x in parts if x.isdigit()]
-        if len(nums) >= 2:
-            target = nums[1]
-            count = int(nums[2]) if len(nums) > 2 else int(nums[1])
-
+        # @用户 优先作为目标
         for comp in event.message_obj.message:
             if isinstance(comp, At):
                 target = str(comp.qq)
-                for n in nums:
-                    if str(n) != target: count = int(n)
 
-        if not target and len(nums) >= 2:
-            target = nums[0]
-            count = int(nums[1])
+        # 数字参数: 无 @ 时第一个为 QQ，其余为数量
+        # 消息文本中可能带有 @ 对象的 QQ 号，只跳过第一次出现
+        at_target = target
+        for p in event.message_str.split():
+            if not p.isdigit(): continue
+            if at_target is not None and p == at_target:
+                at_target = None
+            elif target is None:
+                target = p
+            else:
+                count = int(p)
 
         if target and count is not None:
             msg = await self.economy.admin_add_points(target, count)
@@ -419,14 +490,14 @@ class FigurineProPlugin(Star):
             return
 
         key, val = raw.split(":", 1)
-        self.preset_manager.add_prompt(key.strip(), val.strip())
+        await self.preset_manager.add_prompt(key.strip(), val.strip())
         yield event.plain_result(f"✅ 已添加/修改预设: 【{key.strip()}】")
 
     @filter.command("lm删除")
     async def lm_del(self, event: AstrMessageEvent):
         if not self.is_admin(event): return
         key = event.message_str.replace("lm删除", "").strip()
-        if self.preset_manager.delete_prompt(key):
+        if await self.preset_manager.delete_prompt(key):
             yield event.plain_result(f"🗑️ 已删除预设: 【{key}】")
         else:
             yield event.plain_result(f"❌ 未找到预设: {key}")
@@ -1,12 +1,20 @@
-import json
+import asyncio
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, FrozenSet, List, Tuple
+
+import orjson
+
+from .utils import atomic_write
 
 
 class PresetManager:
     def __init__(self, data_dir: Path):
         self.file_path = data_dir / "presets.json"
         self.presets: Dict[str, str] = {}
+        self._sorted_cache: List[Tuple[str, str]] | None = None
+        self._keys: FrozenSet[str] = frozenset()
+        self._first_chars: FrozenSet[str] = frozenset()
+        self._save_lock = asyncio.Lock()
         self._load()
 
     def _load(self):
@@ -21,37 +29,72 @@ class PresetManager:
             self.save_all(default_presets)
 
         try:
-            content = self.file_path.read_text(encoding="utf-8")
-            self.presets = json.loads(content)
+            self.presets = orjson.loads(self.file_path.read_bytes())
         except Exception as e:
             print(f"Error loading presets: {e}")
             self.presets = {}
+        self._invalidate()
+
+    def _invalidate(self):
+        """预设变更后重建派生缓存"""
+        self._sorted_cache = None
+        self._keys = frozenset(self.presets)
+        self._first_chars = frozenset(k[0] for k in self.presets if k)
+
+    def _dump(self, data: Dict[str, str]) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
 
     def save_all(self, data: Dict[str, str]):
         """保存所有预设"""
         self.presets = data
+        self._invalidate()
         try:
-            self.file_path.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+            atomic_write(self.file_path, self._dump(data))
         except Exception as e:
             print(f"Error saving presets: {e}")
 
+    async def _save_async(self):
+        """在线程中写盘，避免阻塞事件循环；加锁保证写入串行且最后写入的是最新数据"""
+        self._invalidate()
+        async with self._save_lock:
+            try:
+                await asyncio.to_thread(atomic_write, self.file_path, self._dump(self.presets))
+            except Exception as e:
+                print(f"Error saving presets: {e}")
+
+    def may_match(self, text: str) -> bool:
+        """按首字符快速判断文本是否可能命中预设"""
+        if not text: return False
+        ch = text[0]
+        if ch.isspace():
+            text = text.lstrip()
+            if not text: return False
+            ch = text[0]
+        return ch in self._first_chars
+
+    def has_prompt(self, key: str) -> bool:
+        """判断是否存在该预设"""
+        return key in self._keys
+
     def get_prompt(self, key: str) -> str:
         """获取提示词"""
         return self.presets.get(key, "")
 
-    def add_prompt(self, key: str, prompt: str):
+    async def add_prompt(self, key: str, prompt: str):
         """添加或修改预设"""
         self.presets[key] = prompt
-        self.save_all(self.presets)
+        await self._save_async()
 
-    def delete_prompt(self, key: str) -> bool:
+    async def delete_prompt(self, key: str) -> bool:
         """删除预设"""
         if key in self.presets:
             del self.presets[key]
-            self.save_all(self.presets)
+            await self._save_async()
             return True
         return False
 
     def get_all(self) -> List[Tuple[str, str]]:
         """获取所有预设 (key, prompt)"""
-        return sorted(self.presets.items())
\ No newline at end of file
+        if self._sorted_cache is None:
+            self._sorted_cache = sorted(self.presets.items())
+        return self._sorted_cache
\ No newline at end of file
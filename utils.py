@@ -1,36 +1,137 @@
 import io
+import os
+import ssl
 import asyncio
+import tempfile
 import base64
 import aiohttp
 from pathlib import Path
 from PIL import Image as PILImage, ImageDraw, ImageFont
 from astrbot import logger
 
+# 图片下载不校验证书 (部分图床证书不规范)
+_INSECURE_SSL = ssl.create_default_context()
+_INSECURE_SSL.check_hostname = False
+_INSECURE_SSL.verify_mode = ssl.CERT_NONE
+
+# 进程 umask，用于让原子写入的文件权限与普通写入一致 (mkstemp 默认 0600)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def atomic_write(path: Path, data: bytes):
+    """先写同目录下的唯一临时文件再原子替换，避免中断或并发写入时留下不完整的文件"""
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f"{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # 沿用目标文件原有权限，新文件按 umask 默认权限
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class DebouncedFlusher:
+    """合并短时间内的多次变更，由单个后台任务在防抖间隔后调用 flush 落盘"""
+
+    def __init__(self, flush, delay: float = 0.5):
+        self._flush = flush
+        self._delay = delay
+        self._event = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._closing = False
+
+    def mark(self):
+        """标记有待写入的变更"""
+        if self._closing: return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._event.set()
+
+    async def _run_flush(self):
+        try:
+            await self._flush()
+        except Exception as e:
+            logger.error(f"后台写盘失败: {e}")
+
+    async def _run(self):
+        while not self._closing:
+            await self._event.wait()
+            await asyncio.sleep(self._delay)
+            self._event.clear()
+            await self._run_flush()
+
+    async def close(self):
+        """通知后台任务退出并等待其完成 (不取消，避免打断线程中的写入)，再做最后一次落盘"""
+        self._closing = True
+        self._event.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self._run_flush()
+
+
+# 字体缓存 {字号: 字体}，避免每次生成表格都从磁盘加载
+_FONT_CACHE: dict = {}
+
+
+def _get_font(size: int):
+    font = _FONT_CACHE.get(size)
+    if font is None:
+        try:
+            # 简单尝试几个常见中文字体
+            font = ImageFont.truetype("msyh.ttc", size)
+        except:
+            font = ImageFont.load_default()
+        _FONT_CACHE[size] = font
+    return font
+
+
+def _fit_text(font, text: str, max_w: int) -> str:
+    """超出宽度的文字截断并加省略号，避免溢出到相邻单元格"""
+    if font.getlength(text) <= max_w: return text
+    while text and font.getlength(text + "...") > max_w:
+        text = text[:-1]
+    return text + "..."
+
 
 class ImageWorkflow:
     def __init__(self, proxy_url: str | None = None, max_retries: int = 3, timeout: int = 60):
         self.proxy = proxy_url
         self.max_retries = max_retries
         self.timeout = timeout
+        self._session: aiohttp.ClientSession | None = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """获取共享的 ClientSession，复用连接池与 keep-alive"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
 
     async def terminate(self):
-        pass
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     async def download_image(self, url: str) -> bytes | None:
         """通用图片下载"""
         logger.info(f"正在下载图片: {url}")
         for i in range(self.max_retries + 1):
             try:
-                import ssl
-                ssl_context = ssl.create_default_context()
-                ssl_context.check_hostname = False
-                ssl_context.verify_mode = ssl.CERT_NONE
-
-                connector = aiohttp.TCPConnector(ssl=ssl_context)
-                async with aiohttp.ClientSession(connector=connector) as session:
-                    async with session.get(url, proxy=self.proxy, timeout=self.timeout) as resp:
-                        resp.raise_for_status()
-                        return await resp.read()
+                session = self.get_session()
+                async with session.get(url, proxy=self.proxy, timeout=self.timeout, ssl=_INSECURE_SSL) as resp:
+                    resp.raise_for_status()
+                    return await resp.read()
             except Exception as e:
                 if i < self.max_retries:
                     await asyncio.sleep(1)
@@ -43,24 +144,26 @@ class ImageWorkflow:
         """简化的从事件获取图片逻辑"""
         from astrbot.core.message.components import Image, Reply, At
 
-        img_bytes_list = []
+        tasks = []
 
-        # 1. 检查当前消息和回复链
+        # 1. 检查当前消息和回复链 (先收集任务，再并发下载，保持原有顺序)
         msgs = event.message_obj.message
         for seg in msgs:
             if isinstance(seg, Image):  # 直接图片
                 if seg.url:
-                    img_bytes_list.append(await self.download_image(seg.url))
+                    tasks.append(self.download_image(seg.url))
                 elif seg.file:
-                    img_bytes_list.append(await self._load_local(seg.file))
+                    tasks.append(self._load_local(seg.file))
             elif isinstance(seg, Reply) and seg.chain:  # 回复中的图片
                 for item in seg.chain:
                     if isinstance(item, Image):
-                        if item.url: img_bytes_list.append(await self.download_image(item.url))
+                        if item.url: tasks.append(self.download_image(item.url))
 
         # 2. 检查@用户的头像
         # (这里为了代码简洁，仅保留图片下载，如果需要@头像功能可在此恢复原逻辑)
 
+        img_bytes_list = await asyncio.gather(*tasks)
+
         # 过滤 None
         return [img for img in img_bytes_list if img]
 
@@ -71,17 +174,74 @@ class ImageWorkflow:
             return None
 
 
+# 预览表格布局 {质量: (cell_w, cell_h, img_h, pad, font_sz)}
+_TABLE_LAYOUTS = {
+    "标准": (200, 250, 200, 10, 16),
+    "高清": (300, 380, 320, 15, 24),
+    "超清": (400, 500, 420, 20, 30),
+}
+
+
+def _resolve_quality(quality: str) -> str:
+    return quality if quality in _TABLE_LAYOUTS else "超清"
+
+
 class TableGenerator:
+    @staticmethod
+    def thumb_path(src: Path, quality: str) -> Path:
+        """预览图缩略图缓存路径: <源目录>/thumbs/<质量>/<文件名>.png"""
+        return src.parent / "thumbs" / _resolve_quality(quality) / f"{src.stem}.png"
+
+    @staticmethod
+    def _make_thumb(src: Path, quality: str) -> PILImage.Image:
+        """按质量缩放源图并写入缩略图缓存"""
+        cell_w, _, img_h, pad, _ = _TABLE_LAYOUTS[_resolve_quality(quality)]
+        size = (cell_w - 2 * pad, img_h - 2 * pad)
+        p_img = PILImage.open(src)
+        if p_img.format == "JPEG":
+            # JPEG 可在解码阶段按 1/2、1/4、1/8 缩放，减少解码量
+            p_img.draft("RGB", size)
+        p_img = p_img.convert('RGB')
+        p_img.thumbnail(size, PILImage.Resampling.LANCZOS)
+        thumb = TableGenerator.thumb_path(src, quality)
+        try:
+            buf = io.BytesIO()
+            p_img.save(buf, "PNG", optimize=False)
+            thumb.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write(thumb, buf.getvalue())
+        except Exception as e:
+            # 缓存写入失败不影响本次渲染
+            logger.warning(f"写入缩略图失败 {thumb}: {e}")
+        return p_img
+
+    @staticmethod
+    def remove_thumbnails(src: Path):
+        """删除某张源图在所有质量档位下的缩略图"""
+        for quality in _TABLE_LAYOUTS:
+            TableGenerator.thumb_path(src, quality).unlink(missing_ok=True)
+
+    @staticmethod
+    def _load_thumb(src: Path, quality: str) -> PILImage.Image:
+        """优先读取未过期的缩略图缓存，否则重新生成"""
+        thumb = TableGenerator.thumb_path(src, quality)
+        if thumb.exists() and thumb.stat().st_mtime >= src.stat().st_mtime:
+            try:
+                return PILImage.open(thumb).convert('RGB')
+            except Exception as e:
+                # 缓存损坏 (如写入中断)，丢弃后重新生成
+                logger.warning(f"缩略图损坏，重新生成 {thumb}: {e}")
+                thumb.unlink(missing_ok=True)
+        return TableGenerator._make_thumb(src, quality)
+
     @staticmethod
     async def create_preset_table(presets: list[tuple[str, str]], image_getter_func, quality="高清", cols=5) -> bytes:
-        """生成预设预览图"""
+        """生成预设预览图 (PIL 绘制在线程中执行，不阻塞事件循环)"""
+        return await asyncio.to_thread(TableGenerator._render_sync, presets, image_getter_func, quality, cols)
+
+    @staticmethod
+    def _render_sync(presets: list[tuple[str, str]], image_getter_func, quality="高清", cols=5) -> bytes:
         # 参数配置
-        if quality == "标准":
-            cell_w, cell_h, img_h, pad, font_sz = 200, 250, 200, 10, 16
-        elif quality == "高清":
-            cell_w, cell_h, img_h, pad, font_sz = 300, 380, 320, 15, 24
-        else:
-            cell_w, cell_h, img_h, pad, font_sz = 400, 500, 420, 20, 30
+        cell_w, cell_h, img_h, pad, font_sz = _TABLE_LAYOUTS[_resolve_quality(quality)]
 
         rows = (len(presets) + cols - 1) // cols
         table_w = cols * cell_w + (cols + 1) * pad
@@ -90,29 +250,24 @@ class TableGenerator:
         img = PILImage.new('RGB', (table_w, table_h), 'white')
         draw = ImageDraw.Draw(img)
 
-        # 尝试加载字体
-        font = ImageFont.load_default()
-        try:
-            # 简单尝试几个常见中文字体
-            font = ImageFont.truetype("msyh.ttc", font_sz)
-        except:
-            pass
+        font = _get_font(font_sz)
+
+        cells = [(pad + (i % cols) * (cell_w + pad), pad + (i // cols) * (cell_h + pad)) for i in range(len(presets))]
 
-        for i, (name, prompt) in enumerate(presets):
-            row, col = i // cols, i % cols
-            x = pad + col * (cell_w + pad)
-            y = pad + row * (cell_h + pad)
+        # 先批量填充文字区底色 (paste 纯色为 C 层整块填充)
+        for x, y in cells:
+            img.paste((240, 240, 240), (x, y + img_h, x + cell_w + 1, y + cell_h + 1))
 
-            # 绘制边框
-            draw.rectangle([x, y, x + cell_w, y + cell_h], outline='black', width=1)
+        for (name, prompt), (x, y) in zip(presets, cells):
+            # 绘制边框 (文字区已有底色，只画图片区的上、左、右三边)
+            draw.line([(x, y + img_h - 1), (x, y), (x + cell_w, y), (x + cell_w, y + img_h - 1)], fill='black', width=1)
 
             # 尝试获取该预设的预览图 (这里调用传入的回调函数获取本地缓存路径)
             preview_path = image_getter_func(name)
 
             if preview_path and Path(preview_path).exists():
                 try:
-                    p_img = PILImage.open(preview_path).convert('RGB')
-                    p_img.thumbnail((cell_w - 2 * pad, img_h - 2 * pad), PILImage.Resampling.LANCZOS)
+                    p_img = TableGenerator._load_thumb(Path(preview_path), quality)
                     # 居中粘贴
                     px = x + (cell_w - p_img.width) // 2
                     py = y + (img_h - p_img.height) // 2
@@ -124,9 +279,7 @@ class TableGenerator:
                 draw.text((x + 20, y + img_h // 2), "No Preview", fill='gray', font=font)
 
             # 绘制文字
-            text_bg_y = y + img_h
-            draw.rectangle([x, text_bg_y, x + cell_w, text_bg_y + (cell_h - img_h)], fill='#f0f0f0')
-            draw.text((x + 10, text_bg_y + 10), name, fill='black', font=font)
+            draw.text((x + 10, y + img_h + 10), _fit_text(font, name, cell_w - 20), fill='black', font=font)
 
         out = io.BytesIO()
         img.save(out, format='PNG')